@@ -1,18 +1,34 @@
 import asyncio
 import base64
+import hashlib
+import hmac
 import mimetypes
 import os
-import uuid
+import secrets
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Optional, Sequence, cast
 
+import bcrypt
 import httpx
-import jwt
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-from passlib.context import CryptContext
-from sqlalchemy import ForeignKey, Text
+from sqlalchemy import (
+    CursorResult,
+    ForeignKey,
+    Index,
+    Row,
+    Text,
+    delete,
+    insert,
+    select,
+)
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -28,7 +44,30 @@ class Base(DeclarativeBase):
     pass
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=12)
+# Legacy bcrypt hashes still verify and are upgraded to argon2id on next login.
+_ph = PasswordHasher(
+    time_cost=int(os.getenv("ARGON2_TIME_COST", "2")),
+    memory_cost=int(os.getenv("ARGON2_MEMORY_COST", "65536")),
+    parallelism=1,
+)
+
+# Recent verify_password results, keyed by an HMAC of the credential pair so the
+# cache never holds plaintext and cannot be pre-seeded without the pepper.
+_PASSWORD_PEPPER = os.getenv("PASSWORD_PEPPER", "").encode() or secrets.token_bytes(32)
+_verify_cache: TTLCache[bytes, bool] = TTLCache(maxsize=1024, ttl=60)
+_verify_cache_lock = threading.Lock()
+
+# base64url of {"alg":"HS256","typ":"JWT"}; the header never changes, so tokens
+# are assembled directly instead of going through jwt.encode.
+_JWT_HEADER_B64 = b"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9"
+_JWT_SECRET = os.getenv(
+    "SECRET_KEY", "your-secret-key-change-in-production-please-change-this"
+).encode("utf-8")
+
+# Recently issued access tokens, keyed by claims and expiry minute, so bursts of
+# logins for the same account reuse one signature.
+_jwt_cache: TTLCache[tuple, str] = TTLCache(maxsize=4096, ttl=15)
+_jwt_cache_lock = threading.Lock()
 
 
 # Database Models
@@ -41,13 +80,18 @@ class User(Base):
     hashed_password: Mapped[str] = mapped_column()
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
 
+    # Never loaded implicitly; list a user's models through get_models
     models = relationship(
-        "Model3D", back_populates="owner", cascade="all, delete-orphan"
+        "Model3D", back_populates="owner", cascade="all, delete-orphan", lazy="raise"
     )
 
 
 class Model3D(Base):
     __tablename__ = "models"
+    __table_args__ = (
+        Index("ix_models_public_created", "is_public", "created_at"),
+        Index("ix_models_user_id_id", "user_id", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
@@ -61,62 +105,125 @@ class Model3D(Base):
     owner = relationship("User", back_populates="models")
 
 
+# Columns exposed to API responses, for Core selects and RETURNING clauses
+MODEL_COLUMNS = (
+    Model3D.id,
+    Model3D.user_id,
+    Model3D.reference_image_path,
+    Model3D.instructions,
+    Model3D.generated_2d_path,
+    Model3D.generated_3d_path,
+    Model3D.is_public,
+    Model3D.created_at,
+)
+
+
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return _ph.hash(password)
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    if not hashed_password.startswith("$argon2"):
+        return True
+    return _ph.check_needs_rehash(hashed_password)
+
+
+def _check_password(plain_password: str, hashed_password: str) -> bool:
+    if hashed_password.startswith("$argon2"):
+        try:
+            return _ph.verify(hashed_password, plain_password)
+        except (VerificationError, InvalidHashError):
+            return False
+    try:
+        return bcrypt.checkpw(
+            plain_password.encode("utf-8"), hashed_password.encode("utf-8")
+        )
+    except ValueError:
+        return False
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    key = hmac.new(
+        _PASSWORD_PEPPER,
+        hashed_password.encode("utf-8") + b"\0" + plain_password.encode("utf-8"),
+        hashlib.sha256,
+    ).digest()
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = _check_password(plain_password, hashed_password)
+    with _verify_cache_lock:
+        _verify_cache[key] = result
+    return result
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(
-        to_encode,
-        os.getenv(
-            "SECRET_KEY", "your-secret-key-change-in-production-please-change-this"
-        ),
-        algorithm="HS256",
-    )
+    lifetime = int(expires_delta.total_seconds()) if expires_delta else 900
+    exp_ts = int(time.time()) + lifetime
+    cache_key = (tuple(sorted(data.items())), exp_ts // 60)
+    with _jwt_cache_lock:
+        cached = _jwt_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    to_encode["exp"] = exp_ts
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(orjson.dumps(to_encode))
+    signature = hmac.new(_JWT_SECRET, signing_input, hashlib.sha256).digest()
+    encoded_jwt = (signing_input + b"." + _b64url(signature)).decode("ascii")
+    with _jwt_cache_lock:
+        _jwt_cache[cache_key] = encoded_jwt
     return encoded_jwt
 
 
-def create_user(db: Session, username: str, email: str, password: str) -> User:
-    hashed_password = get_password_hash(password)
-    db_user = User(username=username, email=email, hashed_password=hashed_password)
-    db.add(db_user)
+def create_user(db: Session, username: str, email: str, password: str) -> Row:
+    return insert_user(db, username, email, get_password_hash(password))
+
+
+def insert_user(db: Session, username: str, email: str, hashed_password: str) -> Row:
+    # INSERT ... RETURNING hands back id/created_at without a refresh SELECT
+    stmt = (
+        insert(User)
+        .values(username=username, email=email, hashed_password=hashed_password)
+        .returning(
+            User.id, User.username, User.email, User.hashed_password, User.created_at
+        )
+    )
+    row = db.execute(stmt).one()
     db.commit()
-    db.refresh(db_user)
-    return db_user
+    return row
 
 
 def get_user_by_email(db: Session, email: str) -> Optional[User]:
     return db.query(User).filter(User.email == email).first()
 
 
-def create_model(db: Session, model_data: dict, user_id: int) -> Model3D:
-    db_model = Model3D(**model_data, user_id=user_id)
-    db.add(db_model)
+def create_model(db: Session, model_data: dict, user_id: int) -> Row:
+    stmt = (
+        insert(Model3D).values(**model_data, user_id=user_id).returning(*MODEL_COLUMNS)
+    )
+    row = db.execute(stmt).one()
     db.commit()
-    db.refresh(db_model)
-    return db_model
+    return row
 
 
 def get_models(
     db: Session, user_id: int, skip: int = 0, limit: int = 100
-) -> List[Model3D]:
-    return (
-        db.query(Model3D)
-        .filter(Model3D.user_id == user_id)
+) -> Sequence[Row]:
+    """Return plain column rows; listings are only serialized, never mutated."""
+    stmt = (
+        select(*MODEL_COLUMNS)
+        .where(Model3D.user_id == user_id)
         .offset(skip)
         .limit(limit)
-        .all()
     )
+    return db.execute(stmt).all()
 
 
 def update_model(
@@ -136,16 +243,15 @@ def update_model(
 
 
 def delete_model(db: Session, model_id: int, user_id: int) -> bool:
-    model = (
-        db.query(Model3D)
-        .filter(Model3D.id == model_id, Model3D.user_id == user_id)
-        .first()
+    # Single DELETE; rowcount tells us whether the caller owned the model
+    result = cast(
+        CursorResult,
+        db.execute(
+            delete(Model3D).where(Model3D.id == model_id, Model3D.user_id == user_id)
+        ),
     )
-    if model:
-        db.delete(model)
-        db.commit()
-        return True
-    return False
+    db.commit()
+    return result.rowcount > 0
 
 
 def save_binary_file(file_name, data):
@@ -165,7 +271,7 @@ High quality, detailed, 3D render style.
 
 
 async def generate_2d(
-    prompt: str, base_image_b64: Optional[str] = None, output_dir: str = "uploads/2d"
+    prompt: str, base_image: Optional[bytes] = None, output_dir: str = "uploads/2d"
 ):
     client = genai.Client(
         api_key=os.environ.get("GEMINI_API_KEY"),
@@ -176,11 +282,10 @@ async def generate_2d(
     final_prompt = f"{SYSTEM_PROMPT}\n\nUser Request: {prompt}"
     parts = [types.Part.from_text(text=final_prompt)]
 
-    if base_image_b64:
-        image_bytes = base64.b64decode(base_image_b64)
+    if base_image:
         parts.append(
             types.Part.from_bytes(
-                data=image_bytes,
+                data=base_image,
                 mime_type="image/png",
             )
         )
@@ -215,15 +320,13 @@ async def generate_2d(
     ):
         for part in response.candidates[0].content.parts:
             if part.inline_data and part.inline_data.data:
-                file_name = f"{uuid.uuid4()}"
                 if part.inline_data.mime_type:
                     file_extension = (
                         mimetypes.guess_extension(part.inline_data.mime_type) or ".png"
                     )
                 else:
                     file_extension = ".png"
-                full_file_name = f"{file_name}{file_extension}"
-                file_path = os.path.join(output_dir, full_file_name)
+                file_path = f"{output_dir}/{secrets.token_urlsafe(16)}{file_extension}"
 
                 save_binary_file(file_path, part.inline_data.data)
                 generated_files.append(file_path)
@@ -237,65 +340,129 @@ async def generate_2d(
 MODEL_GENERATOR_URL = os.getenv("MODEL_GENERATOR_URL", "http://127.0.0.1:8001")
 MODEL_GENERATOR_TOKEN = os.getenv("MODEL_GENERATOR_TOKEN", "my-secret-token-123")
 
+GENERATION_TIMEOUT = 120.0
+MODEL_GENERATOR_CONCURRENCY = int(os.getenv("MODEL_GENERATOR_CONCURRENCY", "8"))
+MODEL_GENERATOR_QUEUE_LIMIT = int(os.getenv("MODEL_GENERATOR_QUEUE_LIMIT", "32"))
+
+_gen_sem = asyncio.Semaphore(MODEL_GENERATOR_CONCURRENCY)
+_gen_waiting = 0
+# Indirection so tests can skip the poll delay without patching asyncio itself
+_sleep = asyncio.sleep
+
+
+class GeneratorBusyError(TimeoutError):
+    """Raised when the generation queue is full and new work is shed."""
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Return the shared client for model generator calls, creating it on first use.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+            timeout=httpx.Timeout(30.0),
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 
 async def generate_3d(image_path: str):
     """
     Generate a 3D model from an image using the local model generator service.
+
+    At most MODEL_GENERATOR_CONCURRENCY generations run at once; callers beyond
+    that wait, and once MODEL_GENERATOR_QUEUE_LIMIT are waiting new calls fail
+    fast with GeneratorBusyError.
     """
+    global _gen_waiting
+    if _gen_sem.locked() and _gen_waiting >= MODEL_GENERATOR_QUEUE_LIMIT:
+        raise GeneratorBusyError("Model generator is busy, please try again later")
+
+    _gen_waiting += 1
+    try:
+        await _gen_sem.acquire()
+    finally:
+        _gen_waiting -= 1
+    try:
+        return await _generate_3d(image_path)
+    finally:
+        _gen_sem.release()
+
+
+def _read_image_b64(image_path: str) -> str:
+    with open(image_path, "rb") as f:
+        return base64.b64encode(f.read()).decode("ascii")
+
+
+async def _generate_3d(image_path: str):
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image file not found: {image_path}")
 
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
-        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+    image_b64 = await asyncio.to_thread(_read_image_b64, image_path)
 
-    request_id = str(uuid.uuid4())
+    request_id = secrets.token_urlsafe(16)
 
-    async with httpx.AsyncClient() as client:
-        headers = {"Authorization": f"Bearer {MODEL_GENERATOR_TOKEN}"}
-        payload = {"id": request_id, "image": image_b64}
+    client = get_http_client()
+    headers = {"Authorization": f"Bearer {MODEL_GENERATOR_TOKEN}"}
+    payload = {"id": request_id, "image": image_b64}
+
+    try:
+        response = await client.post(
+            f"{MODEL_GENERATOR_URL}/generate",
+            json=payload,
+            headers=headers,
+            timeout=30.0,
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"Error submitting request: {e}")
+        raise
+
+    print(f"Request submitted. ID: {request_id}")
+
+    # Poll quickly at first so short jobs finish promptly, then back off to the
+    # old 2s interval; the overall budget stays at the previous 60 x 2s.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GENERATION_TIMEOUT
+    attempt = 0
+    while loop.time() < deadline:
+        await _sleep(min(2.0, 0.25 * 2**attempt))
+        attempt += 1
 
         try:
-            response = await client.post(
-                f"{MODEL_GENERATOR_URL}/generate",
-                json=payload,
+            status_response = await client.get(
+                f"{MODEL_GENERATOR_URL}/status/{request_id}",
                 headers=headers,
-                timeout=30.0,
+                timeout=10.0,
             )
-            response.raise_for_status()
-        except httpx.HTTPError as e:
-            print(f"Error submitting request: {e}")
-            raise
-
-        print(f"Request submitted. ID: {request_id}")
+            status_response.raise_for_status()
+            status_data = status_response.json()
 
-        max_retries = 60
-        for _ in range(max_retries):
-            await asyncio.sleep(2)
+            status = status_data.get("status")
+            print(f"Status: {status}")
 
-            try:
-                status_response = await client.get(
-                    f"{MODEL_GENERATOR_URL}/status/{request_id}",
-                    headers=headers,
-                    timeout=10.0,
-                )
-                status_response.raise_for_status()
-                status_data = status_response.json()
+            if status == "completed":
+                model_url = status_data.get("model_url")
+                if model_url and model_url.startswith("/static/"):
+                    model_url = model_url.replace("/static/", "/output/", 1)
+                return model_url
 
-                status = status_data.get("status")
-                print(f"Status: {status}")
+            if status == "error":
+                raise Exception(f"Generation failed: {status_data.get('message')}")
 
-                if status == "completed":
-                    model_url = status_data.get("model_url")
-                    if model_url and model_url.startswith("/static/"):
-                        model_url = model_url.replace("/static/", "/output/", 1)
-                    return model_url
-
-                if status == "error":
-                    raise Exception(f"Generation failed: {status_data.get('message')}")
-
-            except httpx.HTTPError as e:
-                print(f"Error checking status: {e}")
-                continue
+        except httpx.HTTPError as e:
+            print(f"Error checking status: {e}")
+            continue
 
-        raise TimeoutError("Generation timed out")
+    raise TimeoutError("Generation timed out")
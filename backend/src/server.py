@@ -1,35 +1,72 @@
+import asyncio
 import base64
+import hashlib
+import hmac
 import os
+import secrets
 import shutil
-import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from types import MappingProxyType
+from typing import Any, BinaryIO, Callable, List, Optional, TypeVar
 
 import jwt
-from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile, status
+import orjson
+from anyio import to_thread
+from cachetools import TLRUCache, TTLCache
+from fastapi import (
+    Depends,
+    FastAPI,
+    File,
+    Form,
+    HTTPException,
+    Request,
+    Response,
+    Security,
+    UploadFile,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi.responses import ORJSONResponse
+from fastapi.security import HTTPBearer
 from fastapi.staticfiles import StaticFiles
 from google.genai.errors import ClientError
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr, TypeAdapter
 from sqlalchemy import (
+    Connection,
     create_engine,
+    event,
+    exists,
+    select,
+    text,
+    tuple_,
 )
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, contains_eager, load_only, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from .modeling import (
     Base,
+    GeneratorBusyError,
     Model3D,
     User,
+    close_http_client,
     create_access_token,
     create_model,
-    create_user,
     delete_model,
     generate_2d,
     generate_3d,
     get_models,
+    get_password_hash,
     get_user_by_email,
+    insert_user,
+    password_needs_rehash,
     update_model,
     verify_password,
 )
@@ -39,8 +76,11 @@ SECRET_KEY = str(
     os.getenv("SECRET_KEY", "your-secret-key-change-in-production-please-change-this")
 )
 ALGORITHM = "HS256"
+_SECRET_BYTES = SECRET_KEY.encode("utf-8")
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 DATABASE_URL = "sqlite:///./imgto3d.db"
+# Sync routes run on anyio's shared worker pool, which defaults to 40 threads
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
 UPLOAD_DIR = Path("uploads/models")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 UPLOAD_2D_DIR = Path("uploads/2d")
@@ -49,11 +89,55 @@ OUTPUT_DIR = Path("output")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 # Database setup
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=8,
+    max_overflow=16,
+    pool_recycle=3600,
+)
+
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets dashboard reads proceed while a write is in flight
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    # Wait for a competing writer instead of failing with "database is locked"
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist, so add newer indexes explicitly
+for index in Base.metadata.tables["models"].indexes:
+    index.create(bind=engine, checkfirst=True)
+
+
+def migrate_legacy_model_urls(conn: Connection) -> None:
+    """Point records saved against the generator's /static/ mount at /output/."""
+    conn.execute(
+        text(
+            "UPDATE models SET generated_3d_path = '/output/' || "
+            "substr(generated_3d_path, instr(generated_3d_path, '/static/') + 8) "
+            "WHERE generated_3d_path GLOB '/static/*' "
+            "OR generated_3d_path GLOB 'http*localhost:8001*/static/*'"
+        )
+    )
+
+
+with engine.begin() as conn:
+    # Superseded by ix_models_user_id_id, which covers the same prefix
+    conn.execute(text("DROP INDEX IF EXISTS ix_models_user_id"))
+    migrate_legacy_model_urls(conn)
 
 
 # Pydantic Schemas
@@ -79,8 +163,7 @@ class UserResponse(BaseModel):
     email: str
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class Model3DCreate(BaseModel):
@@ -102,12 +185,28 @@ class Model3DResponse(BaseModel):
     created_at: datetime
     owner: Optional[UserResponse] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+_models_adapter = TypeAdapter(List[Model3DResponse])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _hash_pool
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    _hash_pool = ThreadPoolExecutor(
+        max_workers=HASH_POOL_SIZE, thread_name_prefix="password-hash"
+    )
+    yield
+    await close_http_client()
+    _hash_pool.shutdown(wait=False)
 
 
 # FastAPI app
-app = FastAPI(title="imgto3d API")
+app = FastAPI(
+    title="imgto3d API", lifespan=lifespan, default_response_class=ORJSONResponse
+)
 
 # CORS middleware
 app.add_middleware(
@@ -116,6 +215,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
@@ -131,10 +231,80 @@ def get_db():
         db.close()
 
 
-def decode_token(token: str) -> dict:
+# Verified token payloads keyed by a hash of the bearer, so repeat requests
+# skip the signature check. Entries never outlive the token's own exp, and
+# only successful decodes are stored.
+def _token_ttu(key: bytes, payload: dict, now: float) -> float:
+    return min(now + 30, payload["exp"])
+
+
+_token_cache: TLRUCache[bytes, dict] = TLRUCache(
+    maxsize=10000, ttu=_token_ttu, timer=time.time
+)
+# Detached User rows per (user_id, token hash), merged back into each request's
+# session without a SELECT.
+_user_cache: TTLCache[tuple[int, bytes], User] = TTLCache(maxsize=10000, ttl=30)
+_auth_cache_lock = threading.Lock()
+
+
+def _b64url_decode(segment: bytes) -> bytes:
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+
+@lru_cache(maxsize=8)
+def _header_is_hs256(segment: bytes) -> bool:
+    # Every token we issue carries the same header, so this parses once
+    try:
+        header = orjson.loads(_b64url_decode(segment))
+    except ValueError:
+        return False
+    return isinstance(header, dict) and header.get("alg") == ALGORITHM
+
+
+def _verify_hs256(token: str) -> dict:
+    """Verify an HS256 token and its exp/sub claims without PyJWT's dispatch."""
+    try:
+        header, payload_segment, signature = token.encode("ascii").split(b".")
+    except (UnicodeEncodeError, ValueError):
+        raise jwt.DecodeError("Not enough segments")
+    if not _header_is_hs256(header):
+        raise jwt.InvalidAlgorithmError("The specified alg value is not allowed")
+
+    expected = hmac.new(
+        _SECRET_BYTES, header + b"." + payload_segment, hashlib.sha256
+    ).digest()
+    try:
+        signature_bytes = _b64url_decode(signature)
+    except ValueError:
+        raise jwt.DecodeError("Invalid signature padding")
+    if not hmac.compare_digest(expected, signature_bytes):
+        raise jwt.InvalidSignatureError("Signature verification failed")
+
+    try:
+        payload = orjson.loads(_b64url_decode(payload_segment))
+    except ValueError:
+        raise jwt.DecodeError("Invalid payload")
+    if not isinstance(payload, dict) or "sub" not in payload:
+        raise jwt.MissingRequiredClaimError("sub")
+
+    exp = payload.get("exp")
+    if not isinstance(exp, int):
+        raise jwt.MissingRequiredClaimError("exp")
+    if exp <= time.time():
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return payload
+
+
+def decode_token(token: str, token_hash: Optional[bytes] = None) -> dict:
+    if token_hash is None:
+        token_hash = hashlib.sha256(token.encode()).digest()
+    with _auth_cache_lock:
+        cached = _token_cache.get(token_hash)
+    if cached is not None:
+        return cached
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
+        payload = _verify_hs256(token)
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired"
@@ -145,39 +315,136 @@ def decode_token(token: str) -> dict:
             detail="Could not validate credentials",
         )
 
+    with _auth_cache_lock:
+        _token_cache[token_hash] = payload
+    return payload
 
-# Security
-security = HTTPBearer()
 
+# Password hashing is deliberately slow, so it gets its own pool rather than
+# competing with sync routes for the shared threadpool. Once HASH_QUEUE_LIMIT
+# calls are pending, new ones are shed with a 503.
+# Argon2 is CPU-bound and each running hash holds ARGON2_MEMORY_COST KiB
+# (64 MiB by default), so more workers than cores only raises peak memory.
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", str(os.cpu_count() or 1)))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "500"))
+T = TypeVar("T")
+# Started and shut down by lifespan
+_hash_pool: Optional[ThreadPoolExecutor] = None
+_hash_pending = 0
 
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db),
-) -> User:
-    token = credentials.credentials
-    payload = decode_token(token)
-    user_id_str: Optional[str] = payload.get("sub")
 
-    if user_id_str is None:
+async def run_password_hashing(func: Callable[..., T], *args: Any) -> T:
+    global _hash_pending
+    if _hash_pending >= HASH_QUEUE_LIMIT:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please try again later",
+            headers={"Retry-After": "1"},
         )
 
+    _hash_pending += 1
     try:
-        user_id = int(user_id_str)
-    except (ValueError, TypeError):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_pool, func, *args)
+    finally:
+        _hash_pending -= 1
+
+
+class BearerToken(HTTPBearer):
+    """HTTPBearer that hands back the raw token instead of a credentials model.
+
+    Keeps the scheme in the OpenAPI schema (and the /docs "Authorize" button)
+    while skipping the per-request HTTPAuthorizationCredentials validation.
+    """
+
+    async def __call__(self, request: Request) -> str:  # type: ignore[override]
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if not (scheme and token):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN, detail="Not authenticated"
+            )
+        if scheme.lower() != "bearer":
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Invalid authentication credentials",
+            )
+        return token
+
+
+security = BearerToken(scheme_name="HTTPBearer")
+
+
+def bearer_and_user(
+    request: Request,
+    token: str = Security(security),
+    db: Session = Depends(get_db),
+) -> User:
+    """Resolve the bearer token to the current user.
+
+    The verified claims are left on `request.state.jwt_payload` as a read-only
+    mapping; anything else that needs them should read them from there rather
+    than decoding again.
+    """
+    token_hash = hashlib.sha256(token.encode()).digest()
+    payload = decode_token(token, token_hash)
+    # Read-only view: the dict is shared through the token cache
+    request.state.jwt_payload = MappingProxyType(payload)
+
+    sub = payload["sub"]
+    if isinstance(sub, str) and sub.isascii() and sub.isdigit():
+        user_id = int(sub)
+    elif isinstance(sub, int) and not isinstance(sub, bool):
+        user_id = sub
+    else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token format"
         )
 
-    user = db.query(User).filter(User.id == user_id).first()
+    cache_key = (user_id, token_hash)
+    with _auth_cache_lock:
+        cached = _user_cache.get(cache_key)
+    if cached is not None:
+        return db.merge(cached, load=False)
+
+    # Primary-key fetch via the identity map; the hash is never needed here
+    user = db.get(
+        User,
+        user_id,
+        options=[load_only(User.id, User.username, User.email, User.created_at)],
+    )
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found"
         )
 
-    return user
+    # Cache the loaded row detached and hand the request a session-bound copy
+    db.expunge(user)
+    with _auth_cache_lock:
+        _user_cache[cache_key] = user
+    return db.merge(user, load=False)
+
+
+def save_upload(src: BinaryIO, dest: str) -> None:
+    """Copy an uploaded file to `dest`, in-kernel when it is spooled to disk."""
+    with open(dest, "wb") as out:
+        # Starlette keeps small uploads in memory; asking those for a fileno
+        # would force a rollover to disk, so only use sendfile once rolled.
+        if getattr(src, "_rolled", True):
+            try:
+                src_fd = src.fileno()
+                size = os.fstat(src_fd).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(out.fileno(), src_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return
+            except (AttributeError, OSError):
+                out.seek(0)
+                out.truncate()
+        src.seek(0)
+        shutil.copyfileobj(src, out, 1 << 20)
 
 
 # API Endpoints
@@ -193,41 +460,74 @@ def root():
     response_model=UserResponse,
     status_code=status.HTTP_201_CREATED,
 )
-def register(user_data: UserRegister, db: Session = Depends(get_db)):
-    if db.query(User).filter(User.username == user_data.username).first():
+async def register(user_data: UserRegister, db: Session = Depends(get_db)):
+    # Database work stays on the threadpool; only the hash uses the hash pool.
+    # One round trip for both checks, so duplicates are rejected before hashing
+    username_taken, email_taken = (
+        await run_in_threadpool(
+            db.execute,
+            select(
+                exists().where(User.username == user_data.username),
+                exists().where(User.email == user_data.email),
+            ),
+        )
+    ).one()
+    if username_taken:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered",
         )
 
-    if get_user_by_email(db, user_data.email):
+    if email_taken:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered"
         )
 
-    return create_user(db, user_data.username, user_data.email, user_data.password)
+    hashed_password = await run_password_hashing(get_password_hash, user_data.password)
+    try:
+        return await run_in_threadpool(
+            insert_user, db, user_data.username, user_data.email, hashed_password
+        )
+    except IntegrityError:
+        # Lost a race with a concurrent registration for the same account
+        await run_in_threadpool(db.rollback)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username or email already registered",
+        )
 
 
 @app.post("/api/auth/login", response_model=Token)
-def login(user_data: UserLogin, db: Session = Depends(get_db)):
-    user = get_user_by_email(db, user_data.email)
+async def login(user_data: UserLogin, db: Session = Depends(get_db)):
+    user = await run_in_threadpool(get_user_by_email, db, user_data.email)
 
-    if not user or not verify_password(user_data.password, user.hashed_password):
+    if not user or not await run_password_hashing(
+        verify_password, user_data.password, user.hashed_password
+    ):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
         )
 
+    # Read before any commit expires the instance and forces a reload
+    user_id = user.id
+    if password_needs_rehash(user.hashed_password):
+        # Upgrade legacy hashes while we still have the plaintext
+        user.hashed_password = await run_password_hashing(
+            get_password_hash, user_data.password
+        )
+        await run_in_threadpool(db.commit)
+
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.id)}, expires_delta=access_token_expires
+        data={"sub": str(user_id)}, expires_delta=access_token_expires
     )
 
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.get("/api/auth/me", response_model=UserResponse)
-def get_me(current_user: User = Depends(get_current_user)):
+def get_me(current_user: User = Depends(bearer_and_user)):
     return current_user
 
 
@@ -236,42 +536,39 @@ def get_me(current_user: User = Depends(get_current_user)):
 )
 def create_model_endpoint(
     model_data: Model3DCreate,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(bearer_and_user),
     db: Session = Depends(get_db),
 ):
-    return create_model(
+    row = create_model(
         db,
-        model_data.dict(exclude_unset=True),
+        model_data.model_dump(exclude_unset=True),
         current_user.id,
     )
+    return {**row._mapping, "owner": UserResponse.model_validate(current_user)}
 
 
 @app.get("/api/models", response_model=List[Model3DResponse])
 def get_models_endpoint(
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(bearer_and_user),
     db: Session = Depends(get_db),
     skip: int = 0,
     limit: int = 100,
 ):
-    models = get_models(db, current_user.id, skip, limit)
-
-    for model in models:
-        if model.generated_3d_path:
-            if "localhost:8001" in model.generated_3d_path:
-                model.generated_3d_path = model.generated_3d_path.split("/static/")[-1]
-                model.generated_3d_path = f"/output/{model.generated_3d_path}"
-            elif model.generated_3d_path.startswith("/static/"):
-                model.generated_3d_path = model.generated_3d_path.replace(
-                    "/static/", "/output/", 1
-                )
-
-    return models
+    # Every row belongs to the caller, so the owner is serialized once. Rows
+    # already match Model3DResponse, so they go straight to orjson.
+    owner = UserResponse.model_validate(current_user).model_dump()
+    return ORJSONResponse(
+        [
+            {**row._mapping, "owner": owner}
+            for row in get_models(db, current_user.id, skip, limit)
+        ]
+    )
 
 
 @app.get("/api/models/{model_id}", response_model=Model3DResponse)
 def get_model(
     model_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(bearer_and_user),
     db: Session = Depends(get_db),
 ):
     model = (
@@ -291,7 +588,7 @@ def get_model(
 @app.delete("/api/models/{model_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_model_endpoint(
     model_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(bearer_and_user),
     db: Session = Depends(get_db),
 ):
     if not delete_model(db, model_id, current_user.id):
@@ -305,11 +602,11 @@ def delete_model_endpoint(
 def update_model_endpoint(
     model_id: int,
     model_data: Model3DCreate,
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(bearer_and_user),
     db: Session = Depends(get_db),
 ):
     updated = update_model(
-        db, model_id, model_data.dict(exclude_unset=True), current_user.id
+        db, model_id, model_data.model_dump(exclude_unset=True), current_user.id
     )
     if not updated:
         raise HTTPException(
@@ -318,14 +615,43 @@ def update_model_endpoint(
     return updated
 
 
+def encode_cursor(model: Model3D) -> str:
+    raw = f"{model.created_at.isoformat()}|{model.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, model_id = (
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode().split("|")
+        )
+        return datetime.fromisoformat(created_at), int(model_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+
 @app.get("/api/public/models", response_model=List[Model3DResponse])
 def get_public_models(
     search: Optional[str] = None,
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
 ):
-    query = db.query(Model3D).join(User).filter(Model3D.is_public.is_(True))
+    """
+    List public models, newest first.
+
+    Pass the `X-Next-Cursor` response header back as `cursor` to fetch the
+    following page without re-scanning the rows already seen.
+    """
+    query = (
+        db.query(Model3D)
+        .join(User)
+        .options(contains_eager(Model3D.owner))
+        .filter(Model3D.is_public.is_(True))
+    )
 
     if search:
         search_term = f"%{search}%"
@@ -335,8 +661,27 @@ def get_public_models(
             | (User.username.ilike(search_term))
         )
 
-    models = query.order_by(Model3D.created_at.desc()).offset(skip).limit(limit).all()
-    return models
+    if cursor:
+        query = query.filter(
+            tuple_(Model3D.created_at, Model3D.id) < decode_cursor(cursor)
+        )
+
+    models = (
+        query.order_by(Model3D.created_at.desc(), Model3D.id.desc())
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
+    # Validate and encode in one pass of the precompiled adapter, straight to bytes
+    response = Response(
+        _models_adapter.dump_json(
+            _models_adapter.validate_python(models, from_attributes=True)
+        ),
+        media_type="application/json",
+    )
+    if models and len(models) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(models[-1])
+    return response
 
 
 @app.post(
@@ -344,7 +689,7 @@ def get_public_models(
 )
 async def generate_model_endpoint(
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(bearer_and_user),
     db: Session = Depends(get_db),
 ):
     filename = file.filename or "upload.png"
@@ -352,45 +697,47 @@ async def generate_model_endpoint(
     if not file_ext:
         file_ext = ".png"
 
-    file_name = f"{uuid.uuid4()}{file_ext}"
-    file_path = UPLOAD_DIR / file_name
+    file_path = f"{UPLOAD_DIR}/{secrets.token_urlsafe(16)}{file_ext}"
 
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    await run_in_threadpool(save_upload, file.file, file_path)
 
     try:
-        model_url = await generate_3d(str(file_path))
+        model_url = await generate_3d(file_path)
     except Exception as e:
         if os.path.exists(file_path):
             os.remove(file_path)
+        if isinstance(e, GeneratorBusyError):
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=str(e),
+                headers={"Retry-After": "5"},
+            )
         raise HTTPException(status_code=500, detail=str(e))
 
     # Create DB record
-    return create_model(
+    row = create_model(
         db,
         {
-            "reference_image_path": str(file_path),
+            "reference_image_path": file_path,
             "generated_3d_path": model_url,
         },
         current_user.id,
     )
+    return {**row._mapping, "owner": UserResponse.model_validate(current_user)}
 
 
 @app.post("/api/generate-2d")
 async def generate_2d_endpoint(
     instructions: str = Form(...),
     file: Optional[UploadFile] = File(None),
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(bearer_and_user),
 ):
-    base_image_b64 = None
-    if file:
-        file_content = await file.read()
-        base_image_b64 = base64.b64encode(file_content).decode("utf-8")
+    base_image = await file.read() if file else None
 
     try:
         file_path = await generate_2d(
             prompt=instructions,
-            base_image_b64=base_image_b64,
+            base_image=base_image,
             output_dir=str(UPLOAD_2D_DIR),
         )
 
@@ -3,13 +3,17 @@ import sys
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
 from sqlalchemy.pool import StaticPool
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Minimal argon2 cost so register/login don't dominate the suite's runtime
+os.environ.setdefault("ARGON2_TIME_COST", "1")
+os.environ.setdefault("ARGON2_MEMORY_COST", "8")
 
-from src.modeling import Base
+from src import modeling, server
+from src.modeling import Base, User
 from src.server import app, get_db
 
 SQLALCHEMY_DATABASE_URL = "sqlite://"
@@ -19,18 +23,57 @@ engine = create_engine(
     connect_args={"check_same_thread": False},
     poolclass=StaticPool,
 )
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
-@pytest.fixture(scope="function")
-def test_db():
+# pysqlite manages transactions itself, which breaks SAVEPOINTs; let SQLAlchemy
+# emit BEGIN so each test can run inside a transaction that is rolled back.
+@event.listens_for(engine, "connect")
+def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(engine, "begin")
+def _emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+@pytest.fixture(autouse=True)
+def clear_auth_caches():
+    # Ids are reused once a test's transaction rolls back, so cached tokens and
+    # users would otherwise leak between tests.
+    for cache in (
+        modeling._verify_cache,
+        modeling._jwt_cache,
+        server._token_cache,
+        server._user_cache,
+    ):
+        cache.clear()
+
+
+@pytest.fixture(scope="module")
+def schema():
     Base.metadata.create_all(bind=engine)
-    db = TestingSessionLocal()
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture(scope="function")
+def test_db(schema):
+    # Commits inside the app only release a SAVEPOINT; the outer transaction
+    # is rolled back so every test starts from the same empty schema.
+    connection = engine.connect()
+    transaction = connection.begin()
+    db = Session(
+        bind=connection,
+        autoflush=False,
+        join_transaction_mode="create_savepoint",
+    )
     try:
         yield db
     finally:
         db.close()
-        Base.metadata.drop_all(bind=engine)
+        transaction.rollback()
+        connection.close()
 
 
 @pytest.fixture(scope="function")
@@ -47,16 +90,22 @@ def client(test_db):
     app.dependency_overrides.clear()
 
 
+@pytest.fixture(scope="session")
+def precomputed_hash():
+    return modeling.get_password_hash("password123")
+
+
 @pytest.fixture
-def auth_headers(client):
-    client.post(
-        "/api/auth/register",
-        json={
-            "username": "testuser",
-            "email": "test@example.com",
-            "password": "password123",
-        },
+def auth_headers(client, test_db, precomputed_hash):
+    # Insert the user directly so only login pays for a password check
+    test_db.add(
+        User(
+            username="testuser",
+            email="test@example.com",
+            hashed_password=precomputed_hash,
+        )
     )
+    test_db.commit()
     response = client.post(
         "/api/auth/login", json={"email": "test@example.com", "password": "password123"}
     )
@@ -1,3 +1,16 @@
+import threading
+import time
+
+import bcrypt
+import jwt
+import pytest
+from starlette.requests import Request
+
+from src import server
+from src.modeling import Model3D, User
+from src.server import migrate_legacy_model_urls
+
+
 def test_register_user(client):
     response = client.post(
         "/api/auth/register",
@@ -13,6 +26,67 @@ def test_register_user(client):
     assert "id" in data
 
 
+def test_register_rejects_duplicates(client):
+    user = {
+        "username": "dupe",
+        "email": "dupe@example.com",
+        "password": "password123",
+    }
+    assert client.post("/api/auth/register", json=user).status_code == 201
+
+    response = client.post("/api/auth/register", json=user)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Username already registered"
+
+    response = client.post(
+        "/api/auth/register", json={**user, "username": "someone-else"}
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Email already registered"
+
+
+def test_register_keeps_database_work_off_hash_pool(client, monkeypatch):
+    threads = []
+    insert_user = server.insert_user
+
+    def recording_insert_user(*args):
+        threads.append(threading.current_thread().name)
+        return insert_user(*args)
+
+    monkeypatch.setattr(server, "insert_user", recording_insert_user)
+    response = client.post(
+        "/api/auth/register",
+        json={
+            "username": "pooluser",
+            "email": "pool@example.com",
+            "password": "password123",
+        },
+    )
+    assert response.status_code == 201
+    assert len(threads) == 1
+    assert not threads[0].startswith("password-hash")
+
+
+def test_login_upgrades_legacy_bcrypt_hash(client, test_db):
+    user = User(
+        username="legacy",
+        email="legacy@example.com",
+        hashed_password=bcrypt.hashpw(
+            b"password123", bcrypt.gensalt(rounds=4)
+        ).decode(),
+    )
+    test_db.add(user)
+    test_db.commit()
+
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "legacy@example.com", "password": "password123"},
+    )
+    assert response.status_code == 200
+    test_db.refresh(user)
+    assert user.hashed_password.startswith("$argon2id$")
+
+
 def test_login_user(client):
     client.post(
         "/api/auth/register",
@@ -33,6 +107,24 @@ def test_login_user(client):
     assert data["token_type"] == "bearer"
 
 
+def test_login_sheds_load_when_hash_queue_full(client, monkeypatch):
+    client.post(
+        "/api/auth/register",
+        json={
+            "username": "loginuser",
+            "email": "login@example.com",
+            "password": "password123",
+        },
+    )
+    monkeypatch.setattr(server, "HASH_QUEUE_LIMIT", 0)
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "login@example.com", "password": "password123"},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
 def test_get_me(client, auth_headers):
     response = client.get("/api/auth/me", headers=auth_headers)
     assert response.status_code == 200
@@ -40,6 +132,89 @@ def test_get_me(client, auth_headers):
     assert data["email"] == "test@example.com"
 
 
+def test_get_me_reuses_cached_user(client, auth_headers):
+    first = client.get("/api/auth/me", headers=auth_headers)
+    assert len(server._user_cache) == 1
+    second = client.get("/api/auth/me", headers=auth_headers)
+    assert second.status_code == 200
+    assert second.json() == first.json()
+
+
+def test_jwt_payload_on_request_state_is_read_only(auth_headers, test_db):
+    token = auth_headers["Authorization"].removeprefix("Bearer ")
+    request = Request({"type": "http", "headers": []})
+    server.bearer_and_user(request, token, test_db)
+
+    with pytest.raises(TypeError):
+        request.state.jwt_payload["sub"] = "0"
+    (cached,) = server._token_cache.values()
+    assert request.state.jwt_payload == cached
+
+
+def test_invalid_token_is_not_cached(client):
+    response = client.get(
+        "/api/auth/me", headers={"Authorization": "Bearer not-a-token"}
+    )
+    assert response.status_code == 401
+    assert len(server._token_cache) == 0
+
+
+def test_missing_or_non_bearer_auth_is_rejected(client):
+    assert client.get("/api/auth/me").status_code == 403
+    response = client.get("/api/auth/me", headers={"Authorization": "Basic abc"})
+    assert response.status_code == 403
+
+
+def test_openapi_declares_bearer_scheme():
+    schema = server.app.openapi()
+    assert schema["components"]["securitySchemes"]["HTTPBearer"] == {
+        "type": "http",
+        "scheme": "bearer",
+    }
+    assert schema["paths"]["/api/auth/me"]["get"]["security"] == [{"HTTPBearer": []}]
+
+
+def test_non_numeric_sub_is_rejected(client):
+    token = jwt.encode(
+        {"sub": "abc", "exp": int(time.time()) + 60}, server._SECRET_BYTES, "HS256"
+    )
+    response = client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Invalid token format"
+
+
+def test_token_without_sub_is_rejected(client):
+    token = jwt.encode(
+        {"exp": int(time.time()) + 60}, server._SECRET_BYTES, algorithm="HS256"
+    )
+    response = client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+
+
+def test_tampered_or_expired_token_is_rejected(client, auth_headers):
+    token = auth_headers["Authorization"].removeprefix("Bearer ")
+    header, payload, signature = token.split(".")
+    flipped = "B" if signature[0] == "A" else "A"
+    forged = f"{header}.{payload}.{flipped}{signature[1:]}"
+    response = client.get("/api/auth/me", headers={"Authorization": f"Bearer {forged}"})
+    assert response.status_code == 401
+
+    unsigned = jwt.encode({"sub": "1", "exp": int(time.time()) + 60}, None, "none")
+    response = client.get(
+        "/api/auth/me", headers={"Authorization": f"Bearer {unsigned}"}
+    )
+    assert response.status_code == 401
+
+    expired = jwt.encode(
+        {"sub": "1", "exp": int(time.time()) - 1}, server._SECRET_BYTES, "HS256"
+    )
+    response = client.get(
+        "/api/auth/me", headers={"Authorization": f"Bearer {expired}"}
+    )
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Token has expired"
+
+
 def test_create_model_api(client, auth_headers):
     response = client.post(
         "/api/models", json={"instructions": "API Model"}, headers=auth_headers
@@ -48,6 +223,7 @@ def test_create_model_api(client, auth_headers):
     data = response.json()
     assert data["instructions"] == "API Model"
     assert data["is_public"] is False
+    assert data["owner"]["username"] == "testuser"
 
 
 def test_get_models_api(client, auth_headers):
@@ -58,6 +234,8 @@ def test_get_models_api(client, auth_headers):
     data = response.json()
     assert len(data) >= 1
     assert data[0]["instructions"] == "Model 1"
+    assert data[0]["owner"]["username"] == "testuser"
+    assert set(data[0]) == set(server.Model3DResponse.model_fields)
 
 
 def test_update_model_api(client, auth_headers):
@@ -75,6 +253,32 @@ def test_update_model_api(client, auth_headers):
     assert response.json()["instructions"] == "Updated"
 
 
+def test_migrate_legacy_model_urls(client, auth_headers, test_db):
+    paths = [
+        "/static/a.glb",
+        "http://localhost:8001/static/b.glb",
+        "/output/c.glb",
+        "/STATIC/mesh/d.glb",
+    ]
+    for path in paths:
+        client.post(
+            "/api/models",
+            json={"instructions": path, "generated_3d_path": path},
+            headers=auth_headers,
+        )
+
+    migrate_legacy_model_urls(test_db.connection())
+    test_db.commit()
+
+    rows = test_db.query(Model3D.generated_3d_path).order_by(Model3D.id).all()
+    assert [r[0] for r in rows] == [
+        "/output/a.glb",
+        "/output/b.glb",
+        "/output/c.glb",
+        "/STATIC/mesh/d.glb",
+    ]
+
+
 def test_delete_model_api(client, auth_headers):
     create_res = client.post(
         "/api/models", json={"instructions": "To Delete"}, headers=auth_headers
@@ -99,3 +303,25 @@ def test_public_models_api(client, auth_headers):
     assert response.status_code == 200
     data = response.json()
     assert isinstance(data, list)
+
+
+def test_public_models_cursor_pagination(client, auth_headers):
+    for i in range(3):
+        client.post(
+            "/api/models",
+            json={"instructions": f"Public {i}", "is_public": True},
+            headers=auth_headers,
+        )
+
+    first = client.get("/api/public/models", params={"limit": 2})
+    assert first.status_code == 200
+    assert [m["instructions"] for m in first.json()] == ["Public 2", "Public 1"]
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = client.get("/api/public/models", params={"limit": 2, "cursor": cursor})
+    assert second.status_code == 200
+    assert [m["instructions"] for m in second.json()] == ["Public 0"]
+    assert "X-Next-Cursor" not in second.headers
+
+    bad = client.get("/api/public/models", params={"cursor": "not-a-cursor"})
+    assert bad.status_code == 400
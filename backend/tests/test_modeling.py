@@ -1,10 +1,21 @@
+from datetime import timedelta
+
+import bcrypt
+import httpx
+import jwt
+import pytest
+
+from src import modeling
 from src.modeling import (
+    create_access_token,
     create_model,
     create_user,
     delete_model,
+    generate_3d,
     get_models,
     get_user_by_email,
     update_model,
+    verify_password,
 )
 
 
@@ -12,7 +23,23 @@ def test_create_user(test_db):
     user = create_user(test_db, "testuser", "test@example.com", "password123")
     assert user.username == "testuser"
     assert user.email == "test@example.com"
-    assert user.hashed_password != "password123"  # Should be hashed
+    assert user.hashed_password.startswith("$argon2id$")
+
+
+def test_verify_password(test_db):
+    user = create_user(test_db, "testuser", "test@example.com", "password123")
+    assert verify_password("password123", user.hashed_password)
+    assert not verify_password("wrong-password", user.hashed_password)
+    # Repeat lookups are served from the verify cache and must agree
+    assert verify_password("password123", user.hashed_password)
+    assert not verify_password("wrong-password", user.hashed_password)
+
+
+def test_verify_password_accepts_legacy_bcrypt():
+    legacy = bcrypt.hashpw(b"password123", bcrypt.gensalt(rounds=4)).decode()
+    assert verify_password("password123", legacy)
+    assert not verify_password("wrong-password", legacy)
+    assert modeling.password_needs_rehash(legacy)
 
 
 def test_get_user_by_email(test_db):
@@ -66,3 +93,54 @@ def test_delete_model(test_db):
 
     models = get_models(test_db, user.id)
     assert len(models) == 0
+
+
+def test_create_access_token_is_standard_hs256():
+    token = create_access_token({"sub": "7"}, timedelta(minutes=5))
+    assert jwt.get_unverified_header(token) == {"alg": "HS256", "typ": "JWT"}
+    payload = jwt.decode(token, modeling._JWT_SECRET, algorithms=["HS256"])
+    assert payload["sub"] == "7"
+    assert isinstance(payload["exp"], int)
+
+
+def test_create_access_token_reuses_recent_token():
+    first = create_access_token({"sub": "42"}, timedelta(minutes=30))
+    second = create_access_token({"sub": "42"}, timedelta(minutes=30))
+    other = create_access_token({"sub": "43"}, timedelta(minutes=30))
+    assert first == second
+    assert first != other
+
+
+@pytest.mark.asyncio
+async def test_generate_3d_polls_until_completed(tmp_path, monkeypatch):
+    image_path = tmp_path / "input.png"
+    image_path.write_bytes(b"\x89PNG fake image")
+    statuses = iter(["queued", "processing", "completed"])
+    delays = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/generate":
+            return httpx.Response(200, json={"status": "queued"})
+        return httpx.Response(
+            200, json={"status": next(statuses), "model_url": "/static/model.glb"}
+        )
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(modeling, "_http_client", client)
+    monkeypatch.setattr(modeling, "_sleep", fake_sleep)
+
+    assert await generate_3d(str(image_path)) == "/output/model.glb"
+    assert delays == [0.25, 0.5, 1.0]
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_generate_3d_sheds_load_when_queue_full(monkeypatch):
+    monkeypatch.setattr(modeling, "_gen_sem", modeling.asyncio.Semaphore(0))
+    monkeypatch.setattr(modeling, "MODEL_GENERATOR_QUEUE_LIMIT", 0)
+
+    with pytest.raises(modeling.GeneratorBusyError):
+        await generate_3d("unused.png")
@@ -1,24 +1,30 @@
+import asyncio
 import base64
-import json
+import binascii
+import copy
+import hashlib
+import hmac
 import logging
 import os
-import random
-import shutil
-import time
-import urllib.error
-import urllib.parse
-import urllib.request
+import secrets
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Dict, Optional
-
-import requests
-import websocket
-from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, status
+from contextlib import asynccontextmanager, suppress
+from typing import Any, Dict, Optional, Set
+
+import httpx
+import orjson
+import websockets
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # optional, only needed when REDIS_URL is set
+    redis = None
 
 # --- Configuration & Setup ---
 logging.basicConfig(level=logging.INFO)
@@ -29,14 +35,141 @@ LOCAL_OUTPUT_DIR = os.environ.get("LOCAL_OUTPUT_DIR", "/output")
 SERVER_ADDRESS = os.environ.get("COMFYUI_SERVER_ADDRESS", "127.0.0.1:8188")
 CLIENT_ID = str(uuid.uuid4())
 MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "4"))
+# Base64 characters, ~15 MB decoded
+MAX_IMAGE_B64_LENGTH = int(os.environ.get("MAX_IMAGE_B64_LENGTH", "20000000"))
 VALID_TOKENS = set(os.environ.get("VALID_TOKENS", "").split(","))
+# Tokens are compared as fixed-length digests in constant time
+_VALID_TOKEN_HASHES = [hashlib.sha256(t.encode()).digest() for t in VALID_TOKENS if t]
+WORKFLOW_TIMEOUT = float(os.environ.get("WORKFLOW_TIMEOUT", "900"))
+WS_CONNECT_TIMEOUT = 10.0
+WS_RECONNECT_MIN_DELAY = 0.5
+WS_RECONNECT_MAX_DELAY = 30.0
+REDIS_URL = os.environ.get("REDIS_URL")
+STATUS_TTL = int(os.environ.get("STATUS_TTL", "3600"))
+STATUS_MAX_ENTRIES = int(os.environ.get("STATUS_MAX_ENTRIES", "10000"))
+
+# --- Status Tracking ---
+# Redis when REDIS_URL is set, so every uvicorn worker sees the same status;
+# otherwise a process-local dict (single worker only).
+if REDIS_URL:
+    if redis is None:
+        raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+    _redis = redis.Redis.from_url(REDIS_URL)
+else:
+    _redis = None
+# Bounded like the Redis keys; only touched from the event loop, so no lock
+request_status: TTLCache = TTLCache(maxsize=STATUS_MAX_ENTRIES, ttl=STATUS_TTL)
+
+
+async def set_status(
+    request_id: str, state: str, message: str, model_url: Optional[str] = None
+):
+    payload = {"status": state, "message": message, "model_url": model_url}
+    if _redis is not None:
+        await _redis.set(f"status:{request_id}", orjson.dumps(payload), ex=STATUS_TTL)
+        return
+    request_status[request_id] = payload
+
+
+async def get_status_data(request_id: str) -> Optional[Dict[str, Any]]:
+    if _redis is not None:
+        raw = await _redis.get(f"status:{request_id}")
+        return orjson.loads(raw) if raw is not None else None
+    return request_status.get(request_id)
+
+
+# Shared keep-alive connection pool to ComfyUI; retries cover connect errors
+_comfy_client = httpx.AsyncClient(
+    base_url=f"http://{SERVER_ADDRESS}",
+    # Limits must be set on the transport; a custom transport ignores the
+    # client's. Jobs are capped at MAX_WORKERS, each one call at a time.
+    transport=httpx.AsyncHTTPTransport(
+        retries=2, limits=httpx.Limits(max_keepalive_connections=MAX_WORKERS * 4)
+    ),
+)
+# Generation tasks in flight; held so they aren't garbage collected mid-run
+_background_tasks: Set[asyncio.Task] = set()
+# At most MAX_WORKERS jobs are submitted to ComfyUI at once; the rest stay
+# "queued" here rather than piling up against WORKFLOW_TIMEOUT in its queue.
+# A job's slot number also names its input image in ComfyUI.
+_free_slots: asyncio.Queue = asyncio.Queue()
+for _slot in range(MAX_WORKERS):
+    _free_slots.put_nowait(_slot)
+
+# One WebSocket to ComfyUI shared by all requests; completion messages are
+# routed to the waiting request by prompt_id.
+_pending_prompts: Dict[str, asyncio.Future] = {}
+_ws_connected = asyncio.Event()
+
+
+def _dispatch_ws_message(out: Any):
+    # Only the final "executing" message of a prompt (node is null) matters;
+    # progress, status and per-node messages are skipped without parsing.
+    # Binary frames are previews. Neither check depends on the separators
+    # (ComfyUI's json.dumps writes '": "').
+    if not isinstance(out, str) or '"executing"' not in out or "null" not in out:
+        return
+    try:
+        message = orjson.loads(out)
+    except orjson.JSONDecodeError:
+        return
+    if message.get("type") != "executing":
+        return
+    data = message.get("data") or {}
+    if data.get("node") is None:
+        future = _pending_prompts.get(data.get("prompt_id"))
+        if future is not None and not future.done():
+            future.set_result(None)
+
+
+def _fail_pending_prompts(exc: Exception):
+    for future in _pending_prompts.values():
+        if not future.done():
+            future.set_exception(exc)
+
+
+async def _ws_dispatcher():
+    url = f"ws://{SERVER_ADDRESS}/ws?clientId={CLIENT_ID}"
+    delay = WS_RECONNECT_MIN_DELAY
+    while True:
+        try:
+            # The asyncio transport already drains every frame buffered per
+            # wake-up. Compression is off: frames are tiny JSON or JPEG
+            # previews over a local link, so inflating each costs more
+            # than it saves.
+            async with websockets.connect(url, max_size=None, compression=None) as ws:
+                logger.info("Connected to ComfyUI WebSocket.")
+                _ws_connected.set()
+                delay = WS_RECONNECT_MIN_DELAY
+                async for out in ws:
+                    _dispatch_ws_message(out)
+        except Exception as e:
+            # Anything short of cancellation (handshake timeouts included)
+            # must end in a reconnect, or every job would wait on a dead task
+            logger.warning(f"ComfyUI WebSocket error: {e!r}")
+        finally:
+            _ws_connected.clear()
+            # Completions sent while disconnected are lost for good
+            _fail_pending_prompts(ConnectionError("Lost connection to ComfyUI"))
+        logger.info(f"Reconnecting to ComfyUI WebSocket in {delay:.1f}s...")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WS_RECONNECT_MAX_DELAY)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    dispatcher = asyncio.create_task(_ws_dispatcher())
+    yield
+    dispatcher.cancel()
+    with suppress(asyncio.CancelledError):
+        await dispatcher
+    await _comfy_client.aclose()
+    if _redis is not None:
+        await _redis.aclose()
 
-# --- In-Memory Status Tracking ---
-# In production, use Redis or a database
-request_status: Dict[str, Dict[str, Any]] = {}
 
 # --- FastAPI App Initialization ---
-app = FastAPI(title="3D Model Generation API", version="1.0.0")
+app = FastAPI(title="3D Model Generation API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -46,16 +179,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/static", StaticFiles(directory=LOCAL_OUTPUT_DIR), name="static")
 
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles for outputs that never change once written.
+
+    ComfyUI gives every saved file a fresh counter-suffixed name, so clients
+    may cache them for good (FileResponse already sets ETag/Last-Modified).
+    """
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+app.mount("/static", ImmutableStaticFiles(directory=LOCAL_OUTPUT_DIR), name="static")
+
 security = HTTPBearer()
 
 
 # --- Pydantic Models ---
 class ImageRequest(BaseModel):
     id: str
-    image: str
+    image: str = Field(max_length=MAX_IMAGE_B64_LENGTH)
 
 
 class GenerationResponse(BaseModel):
@@ -66,9 +212,12 @@ class GenerationResponse(BaseModel):
 
 
 # --- Authentication ---
-def validate_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def validate_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
-    if not VALID_TOKENS or token not in VALID_TOKENS:
+    token_hash = hashlib.sha256(token.encode()).digest()
+    # No short-circuit, so timing doesn't reveal which token matched
+    matches = [hmac.compare_digest(token_hash, h) for h in _VALID_TOKEN_HASHES]
+    if not any(matches):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication token",
@@ -77,14 +226,45 @@ def validate_token(credentials: HTTPAuthorizationCredentials = Depends(security)
     return token
 
 
+async def get_history_outputs(prompt_id: str) -> Dict[str, Any]:
+    try:
+        response = await _comfy_client.get(f"/history/{prompt_id}", timeout=10)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.error(f"Error fetching history for prompt {prompt_id}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="ComfyUI server is not available",
+        )
+    history = orjson.loads(response.content)
+    return history.get(prompt_id, {}).get("outputs", {})
+
+
+def _is_supported_image(image_b64: str) -> bool:
+    """Cheap check of the first 12 decoded bytes for PNG/JPEG/WebP magic."""
+    try:
+        head = base64.b64decode(image_b64[:16], validate=True)
+    except binascii.Error:
+        return False
+    return (
+        head.startswith(b"\x89PNG\r\n\x1a\n")
+        or head.startswith(b"\xff\xd8\xff")
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+    )
+
+
 # --- ComfyUI Functions ---
-def queue_prompt(prompt: Dict[str, Any], prompt_id: str):
+async def queue_prompt(prompt: Dict[str, Any], prompt_id: str):
     p = {"prompt": prompt, "client_id": CLIENT_ID, "prompt_id": prompt_id}
-    data = json.dumps(p).encode("utf-8")
-    req = urllib.request.Request(f"http://{SERVER_ADDRESS}/prompt", data=data)
     try:
-        urllib.request.urlopen(req).read()
-    except urllib.error.URLError as e:
+        response = await _comfy_client.post(
+            "/prompt",
+            content=orjson.dumps(p),
+            headers={"Content-Type": "application/json"},
+            timeout=10,
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
         logger.error(f"Error connecting to ComfyUI server: {e}")
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -92,188 +272,153 @@ def queue_prompt(prompt: Dict[str, Any], prompt_id: str):
         )
 
 
-def upload_file(filepath: str, subfolder: str = "", overwrite: bool = False):
-    if not os.path.exists(filepath):
-        raise FileNotFoundError(f"Input file not found: {filepath}")
-    url = f"http://{SERVER_ADDRESS}/upload/image"
+async def upload_file(
+    filename: str, content: bytes, subfolder: str = "", overwrite: bool = False
+):
     try:
-        with open(filepath, "rb") as f:
-            files = {"image": (os.path.basename(filepath), f)}
-            data = {"subfolder": subfolder, "overwrite": str(overwrite).lower()}
-            response = requests.post(url, files=files, data=data)
-            response.raise_for_status()
-            return response.json()["name"]
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error uploading file {filepath}: {e}")
+        files = {"image": (filename, content)}
+        data = {"subfolder": subfolder, "overwrite": str(overwrite).lower()}
+        response = await _comfy_client.post("/upload/image", files=files, data=data)
+        response.raise_for_status()
+        return response.json()["name"]
+    except httpx.HTTPError as e:
+        logger.error(f"Error uploading file {filename}: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to upload image to ComfyUI",
         )
 
 
-def run_workflow(request_id: str, image_path: str) -> str:
-    """Executes workflow and returns path to 3D model."""
+def _load_workflow_template() -> Dict[str, Any]:
+    """Parse and sanity-check workflow.json, failing at startup if it's unusable."""
     workflow_path = os.path.join(SCRIPT_DIR, "workflow.json")
     if not os.path.exists(workflow_path):
-        logger.error(f"Workflow file not found at '{workflow_path}'")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Workflow configuration not found on server",
-        )
+        raise RuntimeError(f"Workflow file not found at '{workflow_path}'")
+    with open(workflow_path, "rb") as f:
+        workflow = orjson.loads(f.read())
+    if "image" not in workflow.get("2", {}).get("inputs", {}):
+        raise RuntimeError("Image input node ('2') not found in workflow.")
+    return workflow
+
+
+def _save_glb_node_id(workflow: Dict[str, Any]) -> str:
+    for node_id, node_data in workflow.items():
+        if node_data.get("class_type") == "SaveGLB":
+            return node_id
+    raise RuntimeError("SaveGLB node not found in workflow.")
 
-    with open(workflow_path, "r", encoding="utf-8") as f:
-        workflow = json.loads(f.read())
+
+# workflow.json is static; parse it once and copy it per request
+_WORKFLOW_TEMPLATE = _load_workflow_template()
+_HAS_SEED_INPUT = "seed" in _WORKFLOW_TEMPLATE.get("7", {}).get("inputs", {})
+_SAVE_GLB_NODE_ID = _save_glb_node_id(_WORKFLOW_TEMPLATE)
+
+
+async def run_workflow(request_id: str, image: bytes, slot: int) -> str:
+    """Executes workflow and returns path to 3D model."""
+    workflow = copy.deepcopy(_WORKFLOW_TEMPLATE)
 
     # Set random seed
-    seed = random.randint(1, 1000000000)
-    if (
-        "7" in workflow
-        and "inputs" in workflow["7"]
-        and "seed" in workflow["7"]["inputs"]
-    ):
+    seed = secrets.randbits(30) + 1
+    if _HAS_SEED_INPUT:
         workflow["7"]["inputs"]["seed"] = seed
         logger.info(f"Using seed: {seed}")
 
     # Upload image
-    logger.info(f"Uploading {image_path}...")
-    comfyui_path_image = upload_file(image_path, "", True)
+    # One file per job slot: jobs in flight never share a name, and the input
+    # directory holds at most MAX_WORKERS images
+    filename = f"input_{slot}.png"
+    logger.info(f"Uploading {filename} for request {request_id}...")
+    comfyui_path_image = await upload_file(filename, image, "", True)
     logger.info(f"Image uploaded to ComfyUI as: {comfyui_path_image}")
 
-    if (
-        "2" in workflow
-        and "inputs" in workflow["2"]
-        and "image" in workflow["2"]["inputs"]
-    ):
-        workflow["2"]["inputs"]["image"] = comfyui_path_image
-    else:
-        logger.error("Image input node ('2') not found in workflow.")
+    # Node "2" was checked when the template was loaded
+    workflow["2"]["inputs"]["image"] = comfyui_path_image
+
+    # The shared WebSocket must be up before queuing, or the completion
+    # message could be missed
+    try:
+        await asyncio.wait_for(_ws_connected.wait(), WS_CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Workflow configuration is invalid",
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="ComfyUI server is not available",
         )
 
     # Queue prompt
     prompt_id = str(uuid.uuid4())
-    logger.info(f"Queuing prompt with ID: {prompt_id}")
-    queue_prompt(workflow, prompt_id)
-
-    # Wait for completion via WebSocket
-    ws = websocket.WebSocket()
-    ws.connect(f"ws://{SERVER_ADDRESS}/ws?clientId={CLIENT_ID}")
+    done = asyncio.get_running_loop().create_future()
+    _pending_prompts[prompt_id] = done
     try:
+        logger.info(f"Queuing prompt with ID: {prompt_id}")
+        await queue_prompt(workflow, prompt_id)
+
+        # Wait for completion via WebSocket
         logger.info("Waiting for workflow to complete...")
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message["type"] == "executing":
-                    data = message["data"]
-                    if data["node"] is None and data["prompt_id"] == prompt_id:
-                        logger.info("Workflow execution finished.")
-                        break
+        try:
+            await asyncio.wait_for(done, WORKFLOW_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Timed out waiting for ComfyUI",
+            )
+        logger.info("Workflow execution finished.")
     finally:
-        ws.close()
-
-    # Wait for file to be saved
-    time.sleep(3)
-
-    # Find output file
-    filename_prefix = "ComfyUI"
-    for node_id, node_data in workflow.items():
-        if node_data.get("class_type") == "SaveGLB":
-            filename_prefix = node_data["inputs"]["filename_prefix"]
-            break
-
-    if "/" in filename_prefix:
-        subfolder, base_prefix = filename_prefix.rsplit("/", 1)
-    else:
-        subfolder, base_prefix = "", filename_prefix
-
-    full_local_output_path = os.path.join(LOCAL_OUTPUT_DIR, subfolder)
-    if not os.path.exists(full_local_output_path):
-        logger.error(f"Local output directory not found: {full_local_output_path}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Output directory not found",
-        )
-
-    logger.info(
-        f"Searching for newest model file in '{full_local_output_path}' with prefix '{base_prefix}'..."
-    )
-    latest_file = None
-    latest_time = 0
-    for filename in os.listdir(full_local_output_path):
-        if filename.startswith(base_prefix) and filename.endswith(".glb"):
-            file_path = os.path.join(full_local_output_path, filename)
-            file_time = os.path.getmtime(file_path)
-            if file_time > latest_time:
-                latest_time = file_time
-                latest_file = filename
-
-    if not latest_file:
-        logger.error(f"Could not find .glb files with prefix '{base_prefix}'")
+        del _pending_prompts[prompt_id]
+
+    # History names the exact file this prompt saved; it is recorded before
+    # the completion message is sent
+    outputs = await get_history_outputs(prompt_id)
+    saved = outputs.get(_SAVE_GLB_NODE_ID, {}).get("3d")
+    if not saved:
+        logger.error(f"Prompt {prompt_id} produced no .glb output")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to generate 3D model",
         )
 
-    model_relative_path = os.path.join(subfolder, latest_file)
-    logger.info(f"3D model '{latest_file}' found at '{model_relative_path}'.")
+    model_relative_path = os.path.join(saved[0]["subfolder"], saved[0]["filename"])
+    logger.info(f"3D model saved at '{model_relative_path}'.")
     return model_relative_path
 
 
-def process_request(request_id: str, image_data: str):
+async def process_request(request_id: str, image_data: str):
     """Process a 3D model generation request in background."""
+    slot = await _free_slots.get()
+    try:
+        await _process_request(request_id, image_data, slot)
+    finally:
+        _free_slots.put_nowait(slot)
+
+
+async def _process_request(request_id: str, image_data: str, slot: int):
     try:
         # Update status to processing
-        request_status[request_id] = {
-            "status": "processing",
-            "message": "Your request is being processed",
-            "model_url": None,
-        }
-
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
-
-        # Save to temporary file
-        temp_dir = os.path.join("/tmp", request_id)
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_image_path = os.path.join(temp_dir, "input.png")
-        with open(temp_image_path, "wb") as f:
-            f.write(image_bytes)
+        await set_status(request_id, "processing", "Your request is being processed")
+
+        # Decode in memory; the image goes straight into the upload body
+        image = await asyncio.to_thread(base64.b64decode, image_data)
 
         # Run workflow
-        model_relative_path = run_workflow(request_id, temp_image_path)
+        model_relative_path = await run_workflow(request_id, image, slot)
 
         # Update status to completed
         model_url = f"/static/{model_relative_path}"
-        request_status[request_id] = {
-            "status": "completed",
-            "message": "Your 3D model is ready",
-            "model_url": model_url,
-        }
+        await set_status(request_id, "completed", "Your 3D model is ready", model_url)
 
         logger.info(
             f"Request {request_id} completed successfully. Model URL: {model_url}"
         )
 
-        # Clean up temp files
-        shutil.rmtree(temp_dir)
-
     except Exception as e:
         logger.error(f"Error processing request {request_id}: {e}")
-        request_status[request_id] = {
-            "status": "error",
-            "message": f"Failed to generate model: {str(e)}",
-            "model_url": None,
-        }
+        await set_status(request_id, "error", f"Failed to generate model: {str(e)}")
 
 
 # --- API Endpoints ---
 @app.post("/generate", response_model=GenerationResponse)
 async def generate_model(
     request: ImageRequest,
-    background_tasks: BackgroundTasks,
     token: str = Depends(validate_token),
 ):
     """Generate a 3D model from an image."""
@@ -282,16 +427,20 @@ async def generate_model(
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Request ID is required"
         )
+    # Reject junk before it takes a job slot
+    if not _is_supported_image(request.image):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Image must be base64-encoded PNG, JPEG or WebP",
+        )
 
     # Initialize status
-    request_status[request_id] = {
-        "status": "queued",
-        "message": "Your request has been queued",
-        "model_url": None,
-    }
+    await set_status(request_id, "queued", "Your request has been queued")
 
-    # Add background task
-    background_tasks.add_task(process_request, request_id, request.image)
+    # Run in the background on the event loop
+    task = asyncio.create_task(process_request(request_id, request.image))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
     return GenerationResponse(
         status="queued",
@@ -303,13 +452,13 @@ async def generate_model(
 @app.get("/status/{request_id}", response_model=GenerationResponse)
 async def get_status(request_id: str, token: str = Depends(validate_token)):
     """Check the status of a generation request."""
-    if request_id not in request_status:
+    status_data = await get_status_data(request_id)
+    if status_data is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Request ID {request_id} not found",
         )
 
-    status_data = request_status[request_id]
     return GenerationResponse(
         status=status_data["status"],
         message=status_data["message"],
@@ -0,0 +1,105 @@
+"""Tests for the shared ComfyUI WebSocket dispatcher in script_example/api_server.py"""
+
+import asyncio
+import os
+import tempfile
+from contextlib import asynccontextmanager
+
+import orjson
+import pytest
+
+# The module mounts LOCAL_OUTPUT_DIR and reads workflow.json at import
+os.environ.setdefault("LOCAL_OUTPUT_DIR", tempfile.mkdtemp())
+
+from script_example import api_server  # noqa: E402
+
+pytestmark = pytest.mark.asyncio
+
+
+def executing(prompt_id=None, node=None):
+    data = {"node": node}
+    if prompt_id is not None:
+        data["prompt_id"] = prompt_id
+    return orjson.dumps({"type": "executing", "data": data}).decode()
+
+
+class FakeWebSocket:
+    """Yields frames put on `frames` until a None closes the connection."""
+
+    def __init__(self):
+        self.frames = asyncio.Queue()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        while (frame := await self.frames.get()) is not None:
+            yield frame
+
+
+@pytest.fixture
+def fake_connect(monkeypatch):
+    """Replace websockets.connect with a scripted list of outcomes."""
+    outcomes = []
+    attempts = []
+
+    def connect(url, **kwargs):
+        attempts.append(url)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(api_server.websockets, "connect", connect)
+    monkeypatch.setattr(api_server, "WS_RECONNECT_MIN_DELAY", 0.01)
+    monkeypatch.setattr(api_server, "_ws_connected", asyncio.Event())
+    monkeypatch.setattr(api_server, "_pending_prompts", {})
+    return outcomes, attempts
+
+
+@asynccontextmanager
+async def running_dispatcher():
+    task = asyncio.create_task(api_server._ws_dispatcher())
+    yield task
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+async def test_reconnects_after_handshake_timeout(fake_connect):
+    outcomes, attempts = fake_connect
+    ws = FakeWebSocket()
+    outcomes.extend([asyncio.TimeoutError("timed out during opening handshake"), ws])
+
+    async with running_dispatcher() as dispatcher:
+        await asyncio.wait_for(api_server._ws_connected.wait(), 2)
+        assert len(attempts) == 2
+
+        done = asyncio.get_running_loop().create_future()
+        api_server._pending_prompts["p1"] = done
+        # Malformed or unrelated frames must not kill the dispatcher
+        for frame in [b"\x00", executing(), "not json", executing("p1", node="7")]:
+            ws.frames.put_nowait(frame)
+        ws.frames.put_nowait(executing("p1"))
+        await asyncio.wait_for(done, 2)
+        assert not dispatcher.done()
+
+
+async def test_lost_connection_fails_pending_prompts(fake_connect):
+    outcomes, _ = fake_connect
+    ws = FakeWebSocket()
+    outcomes.extend([ws] + [OSError("refused")] * 100)
+
+    async with running_dispatcher() as dispatcher:
+        await asyncio.wait_for(api_server._ws_connected.wait(), 2)
+        done = asyncio.get_running_loop().create_future()
+        api_server._pending_prompts["p1"] = done
+        ws.frames.put_nowait(None)
+
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(done, 2)
+        assert not api_server._ws_connected.is_set()
+        assert not dispatcher.done()